@@ -1,14 +1,25 @@
 from flask import Flask, request, render_template, send_file, jsonify, Response, stream_with_context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import zipfile
 from io import BytesIO
-from werkzeug.utils import secure_filename
+from PIL import Image
 import os
 import logging
 import sys
+import shutil
+import tempfile
 import time
 import json
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Configure logging
 # Use INFO level in production, DEBUG in development
@@ -34,16 +45,20 @@ logger.info(f"  - SECRET_KEY: {'Set' if os.environ.get('SECRET_KEY') else 'Using
 # Try to import face recognition libraries, fall back to demo mode if not available
 FACE_RECOGNITION_AVAILABLE = False
 FACE_RECOGNITION_ERROR = None
+FACE_DETECTION_USE_CUDA = False
 
 try:
     import face_recognition
+    import dlib
     import cv2
     import numpy as np
     FACE_RECOGNITION_AVAILABLE = True
+    FACE_DETECTION_USE_CUDA = bool(dlib.DLIB_USE_CUDA)
     logger.info("✅ Real face recognition libraries loaded successfully!")
     logger.info("   - face_recognition: Available")
     logger.info("   - OpenCV: Available")
     logger.info("   - NumPy: Available")
+    logger.info(f"   - dlib CUDA: {'Available (using CNN face detector)' if FACE_DETECTION_USE_CUDA else 'Not available (using HOG face detector)'}")
 except ImportError as e:
     FACE_RECOGNITION_ERROR = str(e)
     logger.warning("⚠️  Face recognition libraries not available")
@@ -65,9 +80,66 @@ FACE_RECOGNITION_CONFIG = {
     'enabled': FACE_RECOGNITION_AVAILABLE,
     'tolerance': 0.5,  # Lower is stricter matching
     'min_face_distance': 0.5,  # Maximum allowed face distance
+    'detection_model': 'cnn' if FACE_DETECTION_USE_CUDA else 'hog',  # CNN is only fast on a GPU
     'demo_mode': not FACE_RECOGNITION_AVAILABLE
 }
 
+# Number of Drive photos downloaded in parallel while matching
+DOWNLOAD_WORKERS = 16
+
+# Number of downloaded photos encoded and compared against the selfie together
+MATCH_BATCH_SIZE = 16
+
+# Longest side, in pixels, that Drive photos are decoded at before face detection
+PHOTO_DECODE_SIZE = 1024
+
+# Drive URL patterns, compiled once at import
+FOLDER_ID_RE = re.compile(r'/folders/([a-zA-Z0-9_-]+)')
+FILE_ID_RE = re.compile(r'https://drive\.google\.com/file/d/([a-zA-Z0-9_-]+)')
+# File IDs end up in local paths and URLs, so listing entries must look like one
+VALID_FILE_ID_RE = re.compile(r'[a-zA-Z0-9_-]+')
+# JS-escaped JSON listing of a folder's children embedded in the folder page
+DRIVE_IVD_RE = re.compile(r"_DRIVE_ivd'?\]?\s*=\s*'((?:[^'\\]|\\.)*)'")
+
+# Folder pages larger than this are truncated before scanning for files
+MAX_FOLDER_PAGE_BYTES = 2 * 1024 * 1024
+
+# Drive photos larger than this are skipped instead of downloaded
+MAX_PHOTO_DOWNLOAD_BYTES = 20 * 1024 * 1024
+
+# Leading bytes of the JPEG, PNG and GIF formats (WebP is checked separately)
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a')
+
+# In-process LRU cache of downloaded Drive photos, bounded by total size (per worker)
+PHOTO_CACHE_MAX_BYTES = int(os.environ.get('PHOTO_CACHE_MB', 64)) * 1024 * 1024
+# Larger photos are not cached, so concurrent downloads can't buffer much in memory
+PHOTO_CACHE_MAX_ITEM_BYTES = PHOTO_CACHE_MAX_BYTES // 8
+_photo_cache = OrderedDict()
+_photo_cache_bytes = 0
+_photo_cache_lock = threading.Lock()
+
+# Shared HTTP session so Drive requests reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3)
+))
+SESSION.headers.update({'User-Agent': 'Mwi-Photo-Extractor/1.0'})
+# (connect, read) timeout in seconds for every Drive request, so a stalled
+# connection can't hold a download worker, and the response waiting on it, forever
+DRIVE_REQUEST_TIMEOUT = (10, 30)
+
+# On-disk cache of face encodings, keyed by a hash of the image contents
+ENCODING_CACHE_DIR = os.path.join(app.config['UPLOAD_FOLDER'], '.enc_cache')
+ENCODING_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # Drop entries unused for a week
+ENCODING_CACHE_PRUNE_INTERVAL = 60 * 60  # Scan for stale entries at most hourly
+
+# Finished ZIP files are kept this long for the user to download them
+ZIP_MAX_AGE = 60 * 60
+os.makedirs(ENCODING_CACHE_DIR, exist_ok=True)
+_last_cache_prune = 0
+
 # Simple health check endpoint
 @app.route('/health')
 def health_check():
@@ -83,6 +155,7 @@ def api_status():
         'face_recognition': {
             'available': FACE_RECOGNITION_CONFIG['enabled'],
             'demo_mode': FACE_RECOGNITION_CONFIG['demo_mode'],
+            'detection_model': FACE_RECOGNITION_CONFIG['detection_model'],
             'error': FACE_RECOGNITION_ERROR if not FACE_RECOGNITION_AVAILABLE else None
         },
         'version': '1.0.0'
@@ -95,29 +168,17 @@ def index():
     logger.info("Index endpoint called")
     return render_template('index.html')
 
-def check_folder_sharing(folder_id):
-    """Check if a Google Drive folder is publicly accessible."""
-    try:
-        # Try to access the folder
-        folder_url = f"https://drive.google.com/drive/folders/{folder_id}"
-        response = requests.get(folder_url)
-        
-        # Check if we got access denied
-        if "Access denied" in response.text or "You need permission" in response.text:
-            return False, "This folder is not publicly accessible. Please make sure the folder is shared with 'Anyone with the link can view'."
-        
-        # Check if we can see any files
-        file_pattern = r'https://drive\.google\.com/file/d/([a-zA-Z0-9_-]+)'
-        file_ids = re.findall(file_pattern, response.text)
-        
-        if not file_ids:
-            return False, "No files found in this folder or the folder is empty."
-        
-        return True, "Folder is accessible and contains files."
-        
-    except Exception as e:
-        logger.error(f"Error checking folder sharing: {str(e)}")
-        return False, f"Error accessing the folder: {str(e)}"
+def check_folder_sharing(page_text):
+    """Check if a fetched Google Drive folder page is publicly accessible."""
+    # Check if we got access denied
+    if "Access denied" in page_text or "You need permission" in page_text:
+        return False, "This folder is not publicly accessible. Please make sure the folder is shared with 'Anyone with the link can view'."
+    
+    # Check if we can see any files
+    if not FILE_ID_RE.search(page_text) and not DRIVE_IVD_RE.search(page_text):
+        return False, "No files found in this folder or the folder is empty."
+    
+    return True, "Folder is accessible and contains files."
 
 @app.route('/process', methods=['POST'])
 def process_photos():
@@ -149,164 +210,159 @@ def process_photos():
                 yield f"data: {json.dumps({'error': 'Invalid Google Drive folder link'})}\n\n"
                 return
             
+            # Fetch the folder page once for both the sharing check and the file listing
+            try:
+                page_text = fetch_folder_page(folder_id)
+            except Exception as e:
+                logger.error(f"Error checking folder sharing: {str(e)}")
+                yield f"data: {json.dumps({'error': f'Error accessing the folder: {str(e)}'})}\n\n"
+                return
+            
             # Check folder sharing status
-            is_accessible, message = check_folder_sharing(folder_id)
+            is_accessible, message = check_folder_sharing(page_text)
             if not is_accessible:
                 yield f"data: {json.dumps({'error': message})}\n\n"
                 return
             
-            # Save the selfie temporarily
-            selfie_filename = secure_filename(selfie_file.filename)
-            selfie_path = os.path.join(app.config['UPLOAD_FOLDER'], selfie_filename)
-            selfie_file.save(selfie_path)
-            logger.info(f"Selfie saved to {selfie_path}")
+            # Read the selfie into memory; it is decoded from there rather than saved to disk
+            selfie_bytes = selfie_file.read()
 
             # Load and encode the selfie face
             if FACE_RECOGNITION_CONFIG['enabled']:
                 try:
-                    selfie_image = face_recognition.load_image_file(selfie_path)
-                    selfie_encodings = face_recognition.face_encodings(selfie_image)
-                    
-                    if not selfie_encodings:
-                        yield f"data: {json.dumps({'error': 'No face detected in the selfie. Please upload a clear photo of your face.'})}\n\n"
-                        os.remove(selfie_path)
-                        return
+                    prune_encoding_cache()
+                    selfie_hash = hashlib.sha256(selfie_bytes).hexdigest()
+                    selfie_encoding = load_cached_encoding(selfie_hash)
                     
-                    selfie_encoding = selfie_encodings[0]
-                    logger.info("Selfie face encoded successfully")
+                    if selfie_encoding is not None:
+                        logger.info("Selfie face encoding loaded from cache")
+                    else:
+                        with Image.open(BytesIO(selfie_bytes)) as img:
+                            # convert() always copies, so skip it for photos that are already RGB
+                            selfie_image = np.array(img if img.mode == 'RGB' else img.convert('RGB'))
+                        selfie_locations = face_recognition.face_locations(
+                            selfie_image,
+                            model=FACE_RECOGNITION_CONFIG['detection_model']
+                        )
+                        selfie_encodings = face_recognition.face_encodings(
+                            selfie_image,
+                            known_face_locations=selfie_locations
+                        )
+                        
+                        if not selfie_encodings:
+                            yield f"data: {json.dumps({'error': 'No face detected in the selfie. Please upload a clear photo of your face.'})}\n\n"
+                            return
+                        
+                        # float32 halves the memory touched by every distance computation
+                        selfie_encoding = selfie_encodings[0].astype(np.float32)
+                        save_cached_encoding(selfie_hash, selfie_encoding)
+                        logger.info("Selfie face encoded successfully")
                 except Exception as e:
                     logger.error(f"Error processing selfie: {str(e)}")
                     yield f"data: {json.dumps({'error': 'Error processing selfie image. Please try a different photo.'})}\n\n"
-                    if os.path.exists(selfie_path):
-                        os.remove(selfie_path)
                     return
             else:
-                # Demo mode - simulate face encoding
-                selfie_encoding = [random.random() for _ in range(128)]
-                logger.info("Running in demo mode - using simulated face encoding")
+                # Demo mode - matches are simulated, so the selfie is never encoded
+                selfie_encoding = None
+                logger.info("Running in demo mode - skipping selfie face encoding")
             
             # Get list of files from Google Drive
-            drive_files = list_drive_files(folder_id)
+            drive_files = list_drive_files(page_text)
             if not drive_files:
                 yield f"data: {json.dumps({'error': 'No image files found in the specified Google Drive folder'})}\n\n"
-                os.remove(selfie_path)
                 return
             
             logger.info(f"Found {len(drive_files)} files in the Drive folder")
             
-            # Create a temporary directory for matching photos
-            temp_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_matches')
-            os.makedirs(temp_dir, exist_ok=True)
+            # Matches are written into the ZIP file as soon as they are found,
+            # so matched photos don't pile up on disk until the end
+            prune_old_zip_files()
+            # The random suffix keeps runs that start in the same second from sharing an archive
+            zip_filename = f"matching_photos_{int(time.time())}_{uuid.uuid4().hex}.zip"
+            zip_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
+            zipf = None
             
             matching_photos = []
             total_photos = len(drive_files)
             processed_count = 0
             face_detection_errors = 0
             
-            # Process each photo
-            for file in drive_files:
-                if not file['mimeType'].startswith('image/'):
-                    continue
-                    
-                try:
-                    # Download the photo
-                    photo_path = download_drive_file(file['id'], temp_dir)
-                    
-                    if FACE_RECOGNITION_CONFIG['enabled']:
-                        try:
-                            # Load and encode the photo
-                            photo_image = face_recognition.load_image_file(photo_path)
-                            photo_encodings = face_recognition.face_encodings(photo_image)
-                            
-                            if not photo_encodings:
-                                face_detection_errors += 1
-                                logger.warning(f"No faces detected in {file['name']}")
-                                # Clean up downloaded file
-                                if os.path.exists(photo_path):
-                                    os.remove(photo_path)
-                                continue
+            zip_finished = False
+            # Each run downloads into its own temporary directory, so concurrent
+            # requests can't delete each other's photos
+            temp_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+            try:
+                # Download and match photos in batches, reusing cached encodings where possible
+                image_files = [file for file in drive_files if file['mimeType'].startswith('image/')]
+                with closing(iter_photo_matches(image_files, selfie_encoding, temp_dir)) as result_batches:
+                    for results in result_batches:
+                        for file, photo_path, distance in results:
+                            if FACE_RECOGNITION_CONFIG['enabled']:
+                                if distance is None:
+                                    face_detection_errors += 1
+                                    logger.warning("No faces detected in %s", file['name'])
+                                    # Clean up downloaded file
+                                    if photo_path and os.path.exists(photo_path):
+                                        os.remove(photo_path)
+                                    continue
+                                
+                                is_match = is_face_match(distance)
+                                if is_match:
+                                    logger.info("Match found in %s (distance: %.2f)", file['name'], distance)
+                            else:
+                                # Demo mode - matches were picked at random and are the only photos downloaded
+                                is_match = photo_path is not None
+                                if is_match:
+                                    logger.info("Demo mode: Matched %s", file['name'])
                             
-                            # Check if any face in the photo matches the selfie
-                            matches = face_recognition.compare_faces(
-                                [selfie_encoding], 
-                                photo_encodings[0], 
-                                tolerance=FACE_RECOGNITION_CONFIG['tolerance']
-                            )
-                            face_distances = face_recognition.face_distance([selfie_encoding], photo_encodings[0])
+                            if is_match:
+                                if zipf is None:
+                                    # Photos are already compressed, so store them as-is
+                                    zipf = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED)
+                                # Use the original filename in the ZIP
+                                zipf.write(photo_path, file['name'])
+                                matching_photos.append(file['name'])
                             
-                            if matches[0] and face_distances[0] < FACE_RECOGNITION_CONFIG['min_face_distance']:
-                                original_name = file['name']
-                                new_path = os.path.join(temp_dir, original_name)
-                                if os.path.exists(photo_path):
-                                    os.rename(photo_path, new_path)
-                                matching_photos.append(new_path)
-                                logger.info(f"Match found in {original_name} (distance: {face_distances[0]:.2f})")
-                            else:
-                                # Clean up non-matching photo
-                                if os.path.exists(photo_path):
-                                    os.remove(photo_path)
-                        except Exception as e:
-                            logger.error(f"Error processing photo {file['name']}: {str(e)}")
-                            if os.path.exists(photo_path):
+                            # The photo is either archived or not a match, so drop the download
+                            if photo_path and os.path.exists(photo_path):
                                 os.remove(photo_path)
-                            continue
-                    else:
-                        # Demo mode - randomly match photos
-                        if random.random() < 0.3:  # 30% chance of matching
-                            matching_photos.append(photo_path)
-                            logger.info(f"Demo mode: Matched {file['name']}")
-                        else:
-                            # Clean up non-matching photo in demo mode
-                            if os.path.exists(photo_path):
-                                os.remove(photo_path)
-                    
-                    processed_count += 1
-                    progress = (processed_count / total_photos) * 100
-                    logger.info(f"Processed {processed_count}/{total_photos} photos ({progress:.1f}%)")
-                    
-                    # Send progress update
-                    yield f"data: {json.dumps({'progress': progress, 'status': f'Processing photo {processed_count} of {total_photos}'})}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Error processing photo {file['name']}: {str(e)}")
-                    continue
-            
-            # Create ZIP file with matching photos
-            if matching_photos:
-                zip_filename = f"matching_photos_{int(time.time())}.zip"
-                zip_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
-                
-                try:
-                    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                        for photo_path in matching_photos:
-                            if os.path.exists(photo_path):
-                                # Use the original filename in the ZIP
-                                arcname = os.path.basename(photo_path)
-                                zipf.write(photo_path, arcname)
-                    
-                    logger.info(f"Created ZIP file with {len(matching_photos)} matching photos")
-                    
-                    # Clean up temporary files
-                    cleanup_temp_files(temp_dir)
-                    if os.path.exists(selfie_path):
-                        os.remove(selfie_path)
-                    
-                    # Send final progress update
-                    yield f"data: {json.dumps({'progress': 100, 'status': 'Processing complete!', 'download_url': f'/download/{zip_filename}'})}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Error creating ZIP file: {str(e)}")
-                    yield f"data: {json.dumps({'error': 'Error creating ZIP file'})}\n\n"
-            else:
-                error_msg = 'No matching photos found'
-                if face_detection_errors > 0:
-                    error_msg += f'. Note: {face_detection_errors} photos had no detectable faces.'
-                yield f"data: {json.dumps({'error': error_msg})}\n\n"
+                            
+                            processed_count += 1
+                            progress = (processed_count / total_photos) * 100
+                            logger.info("Processed %d/%d photos (%.1f%%)", processed_count, total_photos, progress)
+                            
+                            # Send progress update
+                            yield f"data: {json.dumps({'progress': progress, 'status': f'Processing photo {processed_count} of {total_photos}'})}\n\n"
                 
-                # Clean up
-                cleanup_temp_files(temp_dir)
-                if os.path.exists(selfie_path):
-                    os.remove(selfie_path)
+                # Finish the ZIP file with matching photos
+                if matching_photos:
+                    try:
+                        zipf.close()
+                        zip_finished = True
+                        logger.info(f"Created ZIP file with {len(matching_photos)} matching photos")
+                        
+                        # Send final progress update
+                        yield f"data: {json.dumps({'progress': 100, 'status': 'Processing complete!', 'download_url': f'/download/{zip_filename}'})}\n\n"
+                        
+                    except Exception as e:
+                        logger.error(f"Error creating ZIP file: {str(e)}")
+                        yield f"data: {json.dumps({'error': 'Error creating ZIP file'})}\n\n"
+                else:
+                    error_msg = 'No matching photos found'
+                    if face_detection_errors > 0:
+                        error_msg += f'. Note: {face_detection_errors} photos had no detectable faces.'
+                    yield f"data: {json.dumps({'error': error_msg})}\n\n"
+            finally:
+                # Close the archive on every exit path, and drop it if the run did not finish
+                if zipf is not None:
+                    try:
+                        zipf.close()
+                    except Exception as e:
+                        logger.error(f"Error closing ZIP file: {str(e)}")
+                    if not zip_finished and os.path.exists(zip_path):
+                        os.remove(zip_path)
+                # Remove any downloads left behind, including after a client disconnect
+                shutil.rmtree(temp_dir, ignore_errors=True)
                 
         except Exception as e:
             logger.error(f"Error processing photos: {str(e)}")
@@ -334,31 +390,86 @@ def download_file(filename):
 
 def extract_folder_id(drive_link):
     """Extract folder ID from Google Drive link."""
-    pattern = r'/folders/([a-zA-Z0-9_-]+)'
-    match = re.search(pattern, drive_link)
+    match = FOLDER_ID_RE.search(drive_link)
     return match.group(1) if match else None
 
-def list_drive_files(folder_id):
-    """List files in a public Google Drive folder."""
+def fetch_folder_page(folder_id):
+    """Fetch a Drive folder page, reading at most MAX_FOLDER_PAGE_BYTES of it.
+    
+    Error responses are returned too, since check_folder_sharing looks for
+    Drive's access-denied text in the page body.
+    """
+    folder_url = f"https://drive.google.com/drive/folders/{folder_id}"
+    with SESSION.get(folder_url, stream=True, timeout=DRIVE_REQUEST_TIMEOUT) as response:
+        content = bytearray()
+        for chunk in response.iter_content(chunk_size=65536):
+            content.extend(chunk)
+            if len(content) >= MAX_FOLDER_PAGE_BYTES:
+                logger.warning(f"Folder page {folder_url} truncated at {MAX_FOLDER_PAGE_BYTES} bytes")
+                break
+        encoding = response.encoding or 'utf-8'
+    return bytes(content[:MAX_FOLDER_PAGE_BYTES]).decode(encoding, errors='replace')
+
+def parse_drive_listing(page_text):
+    """Parse the _DRIVE_ivd folder listing from a Drive folder page.
+    
+    Returns a list of (file_id, mime_type) pairs, or None if the page has
+    no listing or it could not be parsed.
+    """
+    match = DRIVE_IVD_RE.search(page_text)
+    if not match:
+        return None
+    
     try:
-        # Construct the folder URL
-        folder_url = f"https://drive.google.com/drive/folders/{folder_id}"
-        
-        # Get the folder page
-        response = requests.get(folder_url)
-        response.raise_for_status()
+        # The listing is a JS string literal of \xNN-escaped JSON
+        raw = match.group(1).encode('latin-1', 'backslashreplace').decode('unicode_escape')
+        data = json.loads(raw)
+        entries = data[0] or []
+        listing = []
+        for entry in entries:
+            file_id, mime_type = entry[0], entry[3]
+            if (isinstance(file_id, str) and isinstance(mime_type, str)
+                    and VALID_FILE_ID_RE.fullmatch(file_id)):
+                listing.append((file_id, mime_type))
+        return listing
+    except (ValueError, IndexError, TypeError) as e:
+        logger.warning(f"Could not parse Drive folder listing: {str(e)}")
+        return None
+
+def list_drive_files(page_text):
+    """List files in a public Google Drive folder from its fetched page."""
+    try:
+        # Prefer the folder's embedded listing, which names only real children
+        # and includes their MIME types, so no per-file metadata requests are needed
+        listing = parse_drive_listing(page_text)
+        if listing is not None:
+            return [
+                {
+                    'id': file_id,
+                    'name': f'photo_{file_id}.jpg',
+                    'mimeType': mime_type
+                }
+                for file_id, mime_type in listing
+                if mime_type.startswith('image/')
+            ]
         
-        # Extract file IDs from the page
-        # Google Drive uses a specific data structure in the page
-        file_pattern = r'https://drive\.google\.com/file/d/([a-zA-Z0-9_-]+)'
-        file_ids = re.findall(file_pattern, response.text)
+        # Otherwise fall back to extracting file IDs from the page links
+        # Google Drive uses a specific data structure in the page, and links
+        # to the same file usually appear several times
+        seen_ids = set()
+        file_ids = []
+        for match in FILE_ID_RE.finditer(page_text):
+            file_id = match.group(1)
+            if file_id not in seen_ids:
+                seen_ids.add(file_id)
+                file_ids.append(file_id)
         
         # Get file details
         files = []
         for file_id in file_ids:
             # Get file metadata
             file_url = f"https://drive.google.com/file/d/{file_id}/view"
-            file_response = requests.get(file_url)
+            file_response = SESSION.get(file_url, timeout=DRIVE_REQUEST_TIMEOUT)
             
             # Check if it's an image
             if any(ext in file_response.text.lower() for ext in ['.jpg', '.jpeg', '.png', '.gif']):
@@ -376,48 +487,362 @@ def list_drive_files(folder_id):
 def download_drive_file(file_id, save_dir):
     """Download a file from a public Google Drive link."""
     try:
+        # Serve repeat downloads from the in-process cache
+        cached = get_cached_photo(file_id)
+        if cached is not None:
+            ext, data = cached
+            file_path = os.path.join(save_dir, f'photo_{file_id}{ext}')
+            with open(file_path, 'wb') as f:
+                f.write(data)
+            return file_path
+        
         # Construct the direct download URL
         download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
         
-        # Download the file
-        response = requests.get(download_url, stream=True)
-        response.raise_for_status()
-        
-        # Determine file type from content-type
-        content_type = response.headers.get('content-type', '')
-        if 'image' not in content_type:
-            raise ValueError(f"Not an image file: {content_type}")
-        
-        # Determine file extension
-        ext = '.jpg'  # default
-        if 'png' in content_type:
-            ext = '.png'
-        elif 'gif' in content_type:
-            ext = '.gif'
+        # Download the file; closing the response returns its connection to the pool
+        with SESSION.get(download_url, stream=True, timeout=DRIVE_REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            
+            # Determine file type from content-type
+            content_type = response.headers.get('content-type', '')
+            if not content_type.startswith('image/'):
+                raise ValueError(f"Not an image file: {content_type}")
+            
+            content_length = int(response.headers.get('content-length', 0))
+            if content_length > MAX_PHOTO_DOWNLOAD_BYTES:
+                raise ValueError(f"File too large: {content_length} bytes")
+            
+            # Determine file extension
+            ext = '.jpg'  # default
+            if 'png' in content_type:
+                ext = '.png'
+            elif 'gif' in content_type:
+                ext = '.gif'
+            
+            # Drive sometimes answers with an HTML quota or virus-scan page, so
+            # check the first bytes before anything is written or decoded
+            content = response.iter_content(chunk_size=65536)
+            first_chunk = next(content, b'')
+            if not has_image_signature(first_chunk):
+                raise ValueError(f"Not an image file: unrecognised data {first_chunk[:8]!r}")
+            
+            # Save the file
+            file_path = os.path.join(save_dir, f'photo_{file_id}{ext}')
+            downloaded = 0
+            # Keep a copy for the in-process cache only while the photo could still fit in it
+            cache_buffer = bytearray()
+            with open(file_path, 'wb') as f:
+                for chunk in chain([first_chunk], content):
+                    if chunk:
+                        downloaded += len(chunk)
+                        if downloaded > MAX_PHOTO_DOWNLOAD_BYTES:
+                            break
+                        f.write(chunk)
+                        if cache_buffer is not None:
+                            if downloaded > PHOTO_CACHE_MAX_ITEM_BYTES:
+                                cache_buffer = None
+                            else:
+                                cache_buffer.extend(chunk)
         
-        # Save the file
-        file_path = os.path.join(save_dir, f'photo_{file_id}{ext}')
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        # Content-Length can be missing or wrong, so enforce the cap on what was actually read
+        if downloaded > MAX_PHOTO_DOWNLOAD_BYTES:
+            os.remove(file_path)
+            raise ValueError(f"File too large: more than {MAX_PHOTO_DOWNLOAD_BYTES} bytes")
         
+        if cache_buffer is not None:
+            cache_photo(file_id, ext, cache_buffer)
         return file_path
     except Exception as e:
-        logger.error(f"Error downloading file {file_id}: {str(e)}")
+        logger.error("Error downloading file %s: %s", file_id, e)
         raise
 
-def cleanup_temp_files(directory):
-    """Clean up temporary files."""
-    for file in os.listdir(directory):
+def has_image_signature(data):
+    """Check whether data starts with the signature of a supported image format."""
+    return data.startswith(IMAGE_SIGNATURES) or (data[:4] == b'RIFF' and data[8:12] == b'WEBP')
+
+def get_cached_photo(file_id):
+    """Return the cached (ext, data) of a downloaded Drive photo, or None."""
+    with _photo_cache_lock:
+        entry = _photo_cache.get(file_id)
+        if entry is not None:
+            _photo_cache.move_to_end(file_id)
+        return entry
+
+def cache_photo(file_id, ext, data):
+    """Add a downloaded photo to the cache, evicting the least recently used ones."""
+    global _photo_cache_bytes
+    if len(data) > PHOTO_CACHE_MAX_ITEM_BYTES:
+        return
+    with _photo_cache_lock:
+        previous = _photo_cache.pop(file_id, None)
+        if previous is not None:
+            _photo_cache_bytes -= len(previous[1])
+        _photo_cache[file_id] = (ext, data)
+        _photo_cache_bytes += len(data)
+        while _photo_cache_bytes > PHOTO_CACHE_MAX_BYTES:
+            _, (_, evicted) = _photo_cache.popitem(last=False)
+            _photo_cache_bytes -= len(evicted)
+
+def load_photo_image(photo_path):
+    """Decode a photo into an RGB array no larger than PHOTO_DECODE_SIZE.
+    
+    JPEGs are decoded straight to a reduced scale and to RGB using
+    libjpeg's DCT scaling (Image.draft), so they need no further colour
+    conversion; other formats are decoded in full, converted and shrunk.
+    """
+    with Image.open(photo_path) as img:
+        img.draft('RGB', (PHOTO_DECODE_SIZE, PHOTO_DECODE_SIZE))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((PHOTO_DECODE_SIZE, PHOTO_DECODE_SIZE))
+        return np.array(img)
+
+def is_face_match(distance):
+    """Check a face distance against the configured matching thresholds."""
+    return (distance <= FACE_RECOGNITION_CONFIG['tolerance']
+            and distance < FACE_RECOGNITION_CONFIG['min_face_distance'])
+
+def photo_cache_key(file_id):
+    """Return the encoding cache key for a Drive photo."""
+    return f'drive_{file_id}'
+
+def closest_face_distances(encodings_per_photo, selfie_encoding):
+    """Return each photo's closest face distance to the selfie.
+    
+    encodings_per_photo holds one (faces, 128) array per photo. Photos with
+    no faces get None. Every face is compared against the selfie in one
+    vectorised call.
+    """
+    results = [None] * len(encodings_per_photo)
+    with_faces = [i for i, encodings in enumerate(encodings_per_photo) if len(encodings)]
+    if with_faces:
+        face_counts = [len(encodings_per_photo[i]) for i in with_faces]
+        # Cache entries written before encodings were stored as float32 are cast here
+        all_encodings = np.concatenate([encodings_per_photo[i] for i in with_faces]).astype(np.float32, copy=False)
+        distances = np.linalg.norm(all_encodings - np.asarray(selfie_encoding, dtype=np.float32), axis=1)
+        # Faces are stored photo by photo, so reduce each photo's run of faces to its minimum
+        offsets = np.concatenate(([0], np.cumsum(face_counts)[:-1]))
+        for i, distance in zip(with_faces, np.minimum.reduceat(distances, offsets)):
+            results[i] = distance
+    return results
+
+def batch_locate_faces(images):
+    """Find face locations for a batch of images with the CNN detector.
+    
+    Images of the same size are sent through batch_face_locations together.
+    Returns a dict of image index to face locations; images whose batch
+    failed (e.g. CUDA running out of memory) are left out so the caller
+    can retry them one at a time.
+    """
+    locations = {}
+    images_by_shape = {}
+    for i, image in enumerate(images):
+        images_by_shape.setdefault(image.shape, []).append(i)
+    for indices in images_by_shape.values():
+        try:
+            batch_locations = face_recognition.batch_face_locations(
+                [images[i] for i in indices],
+                batch_size=len(indices)
+            )
+        except Exception as e:
+            logger.warning("Batched face detection failed, retrying %d photos individually: %s", len(indices), e)
+            continue
+        locations.update(zip(indices, batch_locations))
+    return locations
+
+def match_photo_batch(batch, selfie_encoding):
+    """Encode a batch of downloaded photos and compare them to the selfie.
+    
+    batch is a list of (file, photo_path) pairs. Returns a
+    (file, photo_path, distance) tuple for every photo that could be
+    encoded, and caches each photo's encodings by Drive file ID. Photos
+    that fail to load are logged and removed.
+    """
+    loaded = []
+    images = []
+    for file, photo_path in batch:
+        try:
+            images.append(load_photo_image(photo_path))
+        except Exception as e:
+            logger.error("Error processing photo %s: %s", file['name'], e)
+            if os.path.exists(photo_path):
+                os.remove(photo_path)
+            continue
+        loaded.append((file, photo_path))
+    
+    # With CUDA, detect faces in the whole batch up front
+    batch_locations = {}
+    if FACE_RECOGNITION_CONFIG['detection_model'] == 'cnn':
+        batch_locations = batch_locate_faces(images)
+    
+    encoded = []
+    encodings_per_photo = []
+    for i, ((file, photo_path), photo_image) in enumerate(zip(loaded, images)):
         try:
-            os.remove(os.path.join(directory, file))
+            locations = batch_locations.get(i)
+            if locations is None:
+                locations = face_recognition.face_locations(
+                    photo_image,
+                    model=FACE_RECOGNITION_CONFIG['detection_model']
+                )
+            photo_encodings = face_recognition.face_encodings(photo_image, known_face_locations=locations)
         except Exception as e:
-            logger.error(f"Error deleting file {file}: {str(e)}")
+            logger.error("Error processing photo %s: %s", file['name'], e)
+            if os.path.exists(photo_path):
+                os.remove(photo_path)
+            continue
+        
+        photo_encodings = np.array(photo_encodings, dtype=np.float32).reshape(-1, 128)
+        save_cached_encoding(photo_cache_key(file['id']), photo_encodings)
+        encoded.append((file, photo_path))
+        encodings_per_photo.append(photo_encodings)
+    
+    distances = closest_face_distances(encodings_per_photo, selfie_encoding)
+    return [(file, photo_path, distance) for (file, photo_path), distance in zip(encoded, distances)]
+
+def iter_photo_matches(image_files, selfie_encoding, temp_dir):
+    """Download and match Drive photos, yielding the results in batches.
+    
+    Yields lists of (file, photo_path, distance) tuples, where distance is
+    the photo's closest face distance to the selfie or None if it has no
+    detectable face (always None in demo mode). Photos whose encodings are
+    cached are compared without downloading them, unless they match and
+    are needed for the ZIP file; photo_path is None for those that were
+    not downloaded. Photos that fail to download or encode are left out.
+    
+    In demo mode matches are picked at random up front, so only the
+    matching photos are downloaded.
+    """
+    to_download = image_files
+    known_distances = {}
+    if not FACE_RECOGNITION_CONFIG['enabled']:
+        to_download = []
+        demo_results = []
+        for file in image_files:
+            if random.random() < 0.3:  # 30% chance of matching
+                to_download.append(file)
+            else:
+                demo_results.append((file, None, None))
+        if demo_results:
+            yield demo_results
+    else:
+        to_download = []
+        cached_files = []
+        cached_encodings = []
+        for file in image_files:
+            encodings = load_cached_encoding(photo_cache_key(file['id']))
+            if encodings is None:
+                to_download.append(file)
+            else:
+                cached_files.append(file)
+                cached_encodings.append(encodings)
+        
+        cached_results = []
+        for file, distance in zip(cached_files, closest_face_distances(cached_encodings, selfie_encoding)):
+            if distance is not None and is_face_match(distance):
+                known_distances[file['id']] = distance
+                to_download.append(file)
+            else:
+                cached_results.append((file, None, distance))
+        
+        if cached_files:
+            logger.info(f"Matched {len(cached_files)} photos from cached encodings")
+        if cached_results:
+            yield cached_results
+    
+    executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
     try:
-        os.rmdir(directory)
-    except Exception as e:
-        logger.error(f"Error deleting directory {directory}: {str(e)}")
+        futures = {
+            executor.submit(download_drive_file, file['id'], temp_dir): file
+            for file in to_download
+        }
+        batch = []
+        for completed, future in enumerate(as_completed(futures), 1):
+            file = futures[future]
+            try:
+                batch.append((file, future.result()))
+            except Exception as e:
+                logger.error("Error processing photo %s: %s", file['name'], e)
+            
+            # Keep collecting until the batch is full or every download has finished
+            if len(batch) < MATCH_BATCH_SIZE and completed < len(futures):
+                continue
+            
+            if FACE_RECOGNITION_CONFIG['enabled']:
+                results = [
+                    (file, photo_path, known_distances[file['id']])
+                    for file, photo_path in batch if file['id'] in known_distances
+                ]
+                results.extend(match_photo_batch(
+                    [(file, photo_path) for file, photo_path in batch if file['id'] not in known_distances],
+                    selfie_encoding
+                ))
+            else:
+                results = [(file, photo_path, None) for file, photo_path in batch]
+            
+            yield results
+            batch = []
+    finally:
+        # Drop queued downloads if the caller stops early
+        executor.shutdown(cancel_futures=True)
+
+def load_cached_encoding(key):
+    """Load a cached face encoding, or return None if it is not cached."""
+    cache_path = os.path.join(ENCODING_CACHE_DIR, f'{key}.npy')
+    try:
+        encoding = np.load(cache_path)
+    except (OSError, ValueError):
+        return None
+    # Refresh the timestamp so the pruner keeps entries that are still in use;
+    # another worker may have pruned the file since, which is harmless here
+    try:
+        os.utime(cache_path)
+    except OSError as e:
+        logger.warning("Could not refresh cached encoding %s: %s", key, e)
+    return encoding
+
+def save_cached_encoding(key, encoding):
+    """Store a face encoding in the on-disk cache."""
+    cache_path = os.path.join(ENCODING_CACHE_DIR, f'{key}.npy')
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, encoding)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.error("Error caching face encoding %s: %s", key, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def prune_encoding_cache():
+    """Delete cached face encodings that have not been used recently."""
+    global _last_cache_prune
+    now = time.time()
+    if now - _last_cache_prune < ENCODING_CACHE_PRUNE_INTERVAL:
+        return
+    _last_cache_prune = now
+    
+    cutoff = now - ENCODING_CACHE_MAX_AGE
+    for file in os.listdir(ENCODING_CACHE_DIR):
+        cache_path = os.path.join(ENCODING_CACHE_DIR, file)
+        try:
+            if os.path.getmtime(cache_path) < cutoff:
+                os.remove(cache_path)
+        except OSError as e:
+            logger.error(f"Error pruning cached encoding {file}: {str(e)}")
+
+def prune_old_zip_files():
+    """Delete finished ZIP files older than ZIP_MAX_AGE from the upload folder."""
+    cutoff = time.time() - ZIP_MAX_AGE
+    for file in os.listdir(app.config['UPLOAD_FOLDER']):
+        if not (file.startswith('matching_photos_') and file.endswith('.zip')):
+            continue
+        zip_path = os.path.join(app.config['UPLOAD_FOLDER'], file)
+        try:
+            if os.path.getmtime(zip_path) < cutoff:
+                os.remove(zip_path)
+        except OSError as e:
+            logger.error(f"Error deleting old ZIP file {file}: {str(e)}")
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))